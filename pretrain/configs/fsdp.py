@@ -12,3 +12,5 @@ class fsdp_config:
     fsdp_cpu_offload: bool = False
     pure_bf16: bool = False
     optimizer: str = "AdamW"
+    # False keeps one FlatParameter per FSDP unit, so its grads live in a single contiguous buffer
+    use_orig_params: bool = False
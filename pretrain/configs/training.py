@@ -28,7 +28,12 @@ class train_config:
     save_model: bool=True
     save_optimizer: bool=False
     save_metrics: bool=False
+    checkpoint_every_n_epochs: int=0 # also save on these epochs when eval loss did not improve, 0 disables
     scheduler:str='CosineLR'
     min_lr: float=0
     pos_type: str='sincos3d'
     norm_pixel_loss: bool=True
+    use_expandable_segments: bool=True
+    trace_memory: bool=False
+    compile: bool=False
+    compile_mode: str=None # None picks 'reduce-overhead', or 'max-autotune-no-cudagraphs' under FSDP
@@ -0,0 +1,41 @@
+import torch
+
+
+class CUDAPrefetcher:
+    """Wraps a dataloader and copies the next batch to the GPU on a side stream
+    while the current batch is being consumed (after NVIDIA Apex data_prefetcher).
+    The wrapped dataloader should use pin_memory=True for the copies to overlap.
+    """
+    def __init__(self, loader, device) -> None:
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iter)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def __next__(self):
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+        # the tensors were allocated on the side stream, tell the allocator they are used on this one
+        for v in batch.values():
+            v.record_stream(torch.cuda.current_stream(self.device))
+        self.preload()
+        return batch
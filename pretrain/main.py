@@ -7,6 +7,8 @@ import torch.optim as optim
 import warnings
 warnings.filterwarnings('ignore')
 
+from pkg_resources import packaging
+
 from torch.distributed.fsdp import (
     FullyShardedDataParallel as FSDP,
 )
@@ -48,6 +50,16 @@ def main(**kwargs):
     update_config((train_config, fsdp_config), **kwargs)
     dataset_config = generate_dataset_config(train_config, kwargs)
 
+    if train_config.enable_fsdp:
+        # torchrun specific
+        local_rank = int(os.environ["LOCAL_RANK"])
+        rank = int(os.environ["RANK"])
+        world_size = int(os.environ["WORLD_SIZE"])
+        print(world_size)
+
+    # allocator flags are only honoured if set before the CUDA context exists
+    setup_environ_flags(rank if train_config.enable_fsdp else 0, train_config)
+
     # Set the seeds for reproducibility
     torch.cuda.manual_seed(train_config.seed)
     torch.manual_seed(train_config.seed)
@@ -55,16 +67,10 @@ def main(**kwargs):
 
     if train_config.enable_fsdp:
         setup()
-        # torchrun specific
-        local_rank = int(os.environ["LOCAL_RANK"])
-        rank = int(os.environ["RANK"])
-        world_size = int(os.environ["WORLD_SIZE"])
-        print(world_size)
 
     if torch.distributed.is_initialized():
         torch.cuda.set_device(local_rank)
         clear_gpu_cache(local_rank)
-        setup_environ_flags(rank)
 
     config = Model_Config()
     config.hidden_size = 768
@@ -100,6 +106,7 @@ def main(**kwargs):
             sharding_strategy=fsdp_config.sharding_strategy,
             device_id=torch.cuda.current_device(),
             limit_all_gathers=True,
+            use_orig_params=fsdp_config.use_orig_params,
             sync_module_states=train_config.low_cpu_fsdp,
             param_init_fn=lambda module: module.to_empty(device=torch.device("cuda"), recurse=False)
             if train_config.low_cpu_fsdp and rank != 0 else None,
@@ -113,6 +120,23 @@ def main(**kwargs):
     elif not train_config.enable_fsdp:
         model.to("cuda")
 
+    if train_config.compile:
+        compile_mode = train_config.compile_mode
+        if train_config.enable_fsdp:
+            if packaging.version.parse(torch.__version__).release < (2, 2):
+                raise ValueError(f"torch.compile with FSDP requires torch>=2.2, found {torch.__version__}")
+            if not fsdp_config.use_orig_params:
+                raise ValueError("torch.compile with FSDP requires use_orig_params=True")
+            # CUDA graphs cannot capture the FSDP collectives
+            if compile_mode is None:
+                compile_mode = "max-autotune-no-cudagraphs"
+            elif compile_mode in ("reduce-overhead", "max-autotune"):
+                raise ValueError(f"compile_mode={compile_mode} uses CUDA graphs, which do not work with FSDP")
+        elif compile_mode is None:
+            compile_mode = "reduce-overhead"
+        # nn.Module.compile compiles in place, so the state_dict keys seen by the checkpoint utils are unchanged
+        model.compile(mode=compile_mode, dynamic=False, fullgraph=False)
+
     # dataset_config = generate_dataset_config(train_config, kwargs)
 
      # Load and preprocess the dataset for training and validation
@@ -137,7 +161,7 @@ def main(**kwargs):
     train_dataloader = torch.utils.data.DataLoader(
         dataset_train,
         num_workers=train_config.num_workers_dataloader,
-        pin_memory=False,
+        pin_memory=True,
         **train_dl_kwargs,
     )
 
@@ -4,6 +4,7 @@ import time
 import yaml
 import json
 import math
+import functools
 import torch
 import torch.cuda.nccl as nccl
 import torch.distributed as dist
@@ -16,6 +17,7 @@ from torch.distributed.fsdp import StateDictType
 from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
 from tqdm import tqdm
 
+from data.prefetcher import CUDAPrefetcher
 from utils.model_checkpointing_utils import save_model_checkpoint, save_model_checkpoint_base, save_model_and_optimizer_sharded, save_optimizer_checkpoint
 from policies import fpSixteen,bfSixteen, get_llama_wrapper
 from utils.memory_utils import MemoryTrace
@@ -29,10 +31,7 @@ def adjust_learning_rate(optimizer, epoch, train_config):
         lr = train_config.min_lr + (train_config.lr - train_config.min_lr) * 0.5 * \
             (1. + math.cos(math.pi * (epoch - train_config.warmup_epochs) / (train_config.num_epochs - train_config.warmup_epochs)))
     for param_group in optimizer.param_groups:
-        if "lr_scale" in param_group:
-            param_group["lr"] = lr * param_group["lr_scale"]
-        else:
-            param_group["lr"] = lr
+        param_group["lr"] = lr * param_group.get("lr_scale", 1.0)
     return lr
 
 
@@ -59,11 +58,28 @@ def train(model, train_dataloader,eval_dataloader, optimizer, gradient_accumulat
         scaler = ShardedGradScaler()
     elif train_config.use_fp16 and not train_config.enable_fsdp:
         scaler = torch.cuda.amp.GradScaler()
-    if train_config.enable_fsdp:
-        world_size = int(os.environ["WORLD_SIZE"]) 
+    world_size = int(os.environ["WORLD_SIZE"]) if train_config.enable_fsdp else 1
+    # these are fixed for the whole run, so keep them out of the step loop
+    n_train = len(train_dataloader)
+    total_length = n_train // gradient_accumulation_steps
+    # only rank 0 draws the progress bar, and its loss readout is refreshed about 100 times per epoch
+    show_progress = not train_config.enable_fsdp or rank == 0
+    progress_interval = max(1, total_length // 100)
     # pdb.set_trace()
 
-    autocast = torch.cuda.amp.autocast if train_config.use_fp16 else nullcontext
+    # bf16 has the fp32 exponent range, so it needs no loss scaling; fp16 + scaler is kept for pre-Ampere GPUs
+    use_bf16 = train_config.mixed_precision and not train_config.use_fp16 and _bf16_ready()
+    if train_config.use_fp16:
+        autocast = torch.cuda.amp.autocast
+    elif use_bf16:
+        autocast = functools.partial(torch.autocast, device_type='cuda', dtype=torch.bfloat16)
+    else:
+        autocast = nullcontext
+    device = local_rank if train_config.enable_fsdp else 'cuda:0'
+
+    # non_blocking H2D copies only overlap with compute when the source is page-locked
+    if not train_dataloader.pin_memory and (not train_config.enable_fsdp or rank == 0):
+        print(f"Warning: train_dataloader is not using pin_memory, host to device copies will be synchronous")
 
     train_loss = []
     val_loss =[]
@@ -73,89 +89,93 @@ def train(model, train_dataloader,eval_dataloader, optimizer, gradient_accumulat
         train_step_loss = []
         val_step_loss = []
         
+    # step losses are kept unscaled and multiplied by inv_ga only when read back
+    inv_ga = 1.0 / gradient_accumulation_steps
+    loss_grad = None
+    step_loss_buf = torch.empty(gradient_accumulation_steps, device=device)
     epoch_times = []
     checkpoint_times = []
     results = {}
     best_val_loss = float("inf")
     for epoch in range(train_config.num_epochs):
         epoch_start_time = time.perf_counter()
-        with MemoryTrace() as memtrace:  # track the memory usage
+        # track the memory usage, only on the first epoch since the peaks settle after it
+        memory_trace = MemoryTrace() if train_config.trace_memory and epoch == 0 else nullcontext()
+        with memory_trace as memtrace:
             model.train()
-            total_loss = 0.0
-            total_length = len(train_dataloader)//gradient_accumulation_steps
-            pbar = tqdm(colour="blue", desc=f"Training Epoch: {epoch+1}", total=total_length, dynamic_ncols=True)
-            for step, batch in enumerate(train_dataloader):
-                if train_config.scheduler == 'CosineLR':
-                    lr = adjust_learning_rate(optimizer, step / len(train_dataloader) + epoch, train_config)
-                for key in batch.keys():
-                    if train_config.enable_fsdp:
-                        batch[key] = batch[key].to(local_rank)
+            # accumulate on device in fp32, it is only brought to the host once per epoch
+            total_loss = torch.zeros((), device=device, dtype=torch.float32)
+            pbar = tqdm(colour="blue", desc=f"Training Epoch: {epoch+1}", total=total_length, dynamic_ncols=True, disable=not show_progress)
+            for step, batch in enumerate(CUDAPrefetcher(train_dataloader, device)):
+                is_boundary = (step + 1) % gradient_accumulation_steps == 0 or step == n_train - 1
+                # the lr is only consumed by optimizer.step(), so update it once per accumulation boundary
+                if train_config.scheduler == 'CosineLR' and is_boundary:
+                    lr = adjust_learning_rate(optimizer, step / n_train + epoch, train_config)
+                # FSDP reduce-scatters gradients on every backward; defer it to the micro-step that steps the optimizer.
+                # Note that with a sharded strategy the unsharded grads are kept until then.
+                sync_context = model.no_sync() if train_config.enable_fsdp and not is_boundary else nullcontext()
+                with sync_context:
+                    with autocast():
+                        # loss = model(**batch).loss
+                        loss = model(**batch)[0]
+                    # seed backward with 1/gradient_accumulation_steps instead of dividing the loss every step
+                    if loss_grad is None:
+                        loss_grad = torch.full_like(loss, inv_ga)
+                    if train_config.use_fp16:
+                        # if fp16 is enabled, use gradient scaler to handle gradient update
+                        scaler.scale(loss).backward(gradient=loss_grad)
                     else:
-                        batch[key] = batch[key].to('cuda:0')
-                with autocast():
-                    # loss = model(**batch).loss
-                    loss = model(**batch)[0]
-                loss = loss / gradient_accumulation_steps
-                if train_config.save_metrics:
-                    train_step_loss.append(loss.detach().float().item())
-                total_loss += loss.detach().float()
-                if train_config.use_fp16:
-                    # if fp16 is enabled, use gradient scaler to handle gradient update
-                    scaler.scale(loss).backward()
-                    if (step + 1) % gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
-                        if train_config.gradient_clipping and train_config.gradient_clipping_threshold > 0.0:
+                        # regular backpropagation when fp16 is not used (fp32 or bf16 autocast)
+                        loss.backward(gradient=loss_grad)
+                step_loss_buf[step % gradient_accumulation_steps] = loss.detach()
+                total_loss += loss.detach()
+
+                if is_boundary:
+                    if train_config.gradient_clipping and train_config.gradient_clipping_threshold > 0.0:
+                        if train_config.use_fp16:
                             scaler.unscale_(optimizer)
-                            if train_config.enable_fsdp:
-                                model.clip_grad_norm_(train_config.gradient_clipping_threshold)
-                            else:
-                                torch.nn.utils.clip_grad_norm_(model.parameters(), train_config.gradient_clipping_threshold)
+                        if train_config.enable_fsdp:
+                            model.clip_grad_norm_(train_config.gradient_clipping_threshold)
+                        else:
+                            torch.nn.utils.clip_grad_norm_(model.parameters(), train_config.gradient_clipping_threshold)
+                    if train_config.use_fp16:
                         scaler.step(optimizer)
                         scaler.update()
-                        optimizer.zero_grad()
-                        pbar.update(1)
-                else:
-                    # regular backpropagation when fp16 is not used
-                    loss.backward()
-                    if (step + 1) % gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
-                        if train_config.gradient_clipping and train_config.gradient_clipping_threshold > 0.0:
-                            if train_config.enable_fsdp:
-                                model.clip_grad_norm_(train_config.gradient_clipping_threshold)
-                            else:
-                                torch.nn.utils.clip_grad_norm_(model.parameters(), train_config.gradient_clipping_threshold)
+                    else:
                         optimizer.step()
-                        optimizer.zero_grad()
-                        pbar.update(1)
-
-                pbar.set_description(f"Training Epoch: {epoch+1}/{train_config.num_epochs}, step {step}/{len(train_dataloader)} completed (loss: {loss.detach().float()})")
-
-                if train_config.save_metrics:
-                    save_to_json(metrics_filename, train_step_loss, train_loss, val_step_loss, val_loss)
+                    optimizer.zero_grad(set_to_none=True)
+                    pbar.update(1)
+
+                    show_loss = show_progress and ((step // gradient_accumulation_steps) % progress_interval == 0 or step == n_train - 1)
+                    if train_config.save_metrics or show_loss:
+                        # bring the step losses to the host once per optimizer step instead of syncing every micro-step
+                        step_losses = (step_loss_buf[:step % gradient_accumulation_steps + 1] * inv_ga).tolist()
+                        if train_config.save_metrics:
+                            train_step_loss.extend(step_losses)
+                        if show_loss:
+                            pbar.set_description(f"Training Epoch: {epoch+1}/{train_config.num_epochs}, step {step}/{n_train} completed (loss: {step_losses[-1]})")
             pbar.close()
+            # Reducing total_loss across all devices if there's more than one CUDA device,
+            # issued async; when the epoch is memory traced it overlaps with the MemoryTrace teardown and the memory report
+            reduce_handle = None
+            if torch.cuda.device_count() > 1 and train_config.enable_fsdp:
+                reduce_handle = dist.all_reduce(total_loss, op=dist.ReduceOp.SUM, async_op=True)
 
         epoch_end_time = time.perf_counter()-epoch_start_time
         epoch_times.append(epoch_end_time)
-        # Reducing total_loss across all devices if there's more than one CUDA device
-        if torch.cuda.device_count() > 1 and train_config.enable_fsdp:
-            dist.all_reduce(total_loss, op=dist.ReduceOp.SUM)
-        train_epoch_loss = total_loss / len(train_dataloader)
-        if train_config.enable_fsdp:
-            train_epoch_loss = train_epoch_loss/world_size
-        train_loss.append(float(train_epoch_loss))
-        
-        if train_config.enable_fsdp:
-            if rank==0:
-                print(f"Max CUDA memory allocated was {memtrace.peak} GB")
-                print(f"Max CUDA memory reserved was {memtrace.max_reserved} GB")
-                print(f"Peak active CUDA memory was {memtrace.peak_active_gb} GB")
-                print(f"Cuda Malloc retires : {memtrace.cuda_malloc_retires}")
-                print(f"CPU Total Peak Memory consumed during the train (max): {memtrace.cpu_peaked + memtrace.cpu_begin} GB")
-        else:
+
+        if memtrace is not None and (not train_config.enable_fsdp or rank==0):
             print(f"Max CUDA memory allocated was {memtrace.peak} GB")
             print(f"Max CUDA memory reserved was {memtrace.max_reserved} GB")
             print(f"Peak active CUDA memory was {memtrace.peak_active_gb} GB")
             print(f"Cuda Malloc retires : {memtrace.cuda_malloc_retires}")
             print(f"CPU Total Peak Memory consumed during the train (max): {memtrace.cpu_peaked + memtrace.cpu_begin} GB")
 
+        if reduce_handle is not None:
+            reduce_handle.wait()
+        train_epoch_loss = (total_loss * inv_ga / n_train / world_size).item()
+        train_loss.append(train_epoch_loss)
+
         if train_config.run_validation:
             if test_dataloader is not None:
                 evaluation(model, train_config, test_dataloader, local_rank, epoch, dataset_config, 'test')
@@ -164,7 +184,8 @@ def train(model, train_dataloader,eval_dataloader, optimizer, gradient_accumulat
                 val_step_loss.extend(temp_val_loss)
 
             checkpoint_start_time = time.perf_counter()
-            if train_config.save_model and (eval_epoch_loss < best_val_loss or (epoch + 1) % 10 == 0):
+            periodic_save = train_config.checkpoint_every_n_epochs > 0 and (epoch + 1) % train_config.checkpoint_every_n_epochs == 0
+            if train_config.save_model and (eval_epoch_loss < best_val_loss or periodic_save):
                 if train_config.enable_fsdp:
                     dist.barrier()
                 if not train_config.enable_fsdp:
@@ -235,6 +256,8 @@ def train(model, train_dataloader,eval_dataloader, optimizer, gradient_accumulat
     return results
 
 
+# Ensure no gradients are computed for the whole evaluation to save memory
+@torch.no_grad()
 def evaluation(model,train_config, eval_dataloader, local_rank, split='val'):
     """
     Evaluates the model on the given dataloader
@@ -246,38 +269,35 @@ def evaluation(model,train_config, eval_dataloader, local_rank, split='val'):
 
     Returns: eval_epoch_loss
     """
-    if train_config.enable_fsdp:
-        world_size = int(os.environ["WORLD_SIZE"])
+    world_size = int(os.environ["WORLD_SIZE"]) if train_config.enable_fsdp else 1
+    n_eval = len(eval_dataloader)
+    device = local_rank if train_config.enable_fsdp else 'cuda:0'
     model.eval()
     val_step_loss = []
-    eval_loss = 0.0  # Initialize evaluation loss
+    eval_loss = torch.zeros((), device=device, dtype=torch.float32)  # Initialize evaluation loss
+
+    with MemoryTrace() if train_config.trace_memory else nullcontext():
+        for step, batch in enumerate(tqdm(CUDAPrefetcher(eval_dataloader, device),colour="green", desc="evaluating Epoch", dynamic_ncols=True, disable=train_config.enable_fsdp and dist.get_rank() != 0)):
+            # Forward pass and compute loss
+            outputs = model(**batch)
+            # loss = outputs.loss
+            loss = outputs[0]
+            if train_config.save_metrics:
+                val_step_loss.append(loss.detach().float().item())
 
-    with MemoryTrace() as memtrace:
-        for step, batch in enumerate(tqdm(eval_dataloader,colour="green", desc="evaluating Epoch", dynamic_ncols=True)):
-            for key in batch.keys():
-                if train_config.enable_fsdp:
-                    batch[key] = batch[key].to(local_rank)
-                else:
-                    batch[key] = batch[key].to('cuda:0')
-            # Ensure no gradients are computed for this scope to save memory
-            with torch.no_grad():
-                # Forward pass and compute loss
-                outputs = model(**batch)
-                # loss = outputs.loss
-                loss = outputs[0]
-                if train_config.save_metrics:
-                    val_step_loss.append(loss.detach().float().item())
-
-                eval_loss += loss.detach().float()
-
-    # If there's more than one CUDA device, reduce evaluation loss across all devices
-    if torch.cuda.device_count() > 1 and train_config.enable_fsdp:
-        dist.all_reduce(eval_loss, op=dist.ReduceOp.SUM)
+            eval_loss += loss.detach()
+
+        # If there's more than one CUDA device, reduce evaluation loss across all devices,
+        # issued async so it overlaps with the MemoryTrace teardown when trace_memory is set
+        reduce_handle = None
+        if torch.cuda.device_count() > 1 and train_config.enable_fsdp:
+            reduce_handle = dist.all_reduce(eval_loss, op=dist.ReduceOp.SUM, async_op=True)
+
+    if reduce_handle is not None:
+        reduce_handle.wait()
 
     # Compute average loss
-    eval_epoch_loss = eval_loss / len(eval_dataloader)
-    if train_config.enable_fsdp:
-        eval_epoch_loss = eval_epoch_loss/world_size
+    eval_epoch_loss = (eval_loss / n_eval / world_size).item()
 
     # Print evaluation metrics
     if train_config.enable_fsdp:
@@ -301,14 +321,21 @@ def setup():
     dist.init_process_group("nccl")
 
 
-def setup_environ_flags(rank):
-    """Set environment flags for debugging purposes"""
+def setup_environ_flags(rank, train_config=None):
+    """Set environment flags for debugging purposes
+
+    Must be called before the CUDA context is created, otherwise the allocator
+    settings are ignored.
+    """
     os.environ["TORCH_SHOW_CPP_STACKTRACES"] = str(1)
     os.environ["NCCL_ASYNC_ERROR_HANDLING"] = str(1)
     # os.environ["TORCH_DISTRIBUTED_DEBUG"] = "DETAIL"
+    # Stop NCCL from extending the lifetime of FSDP all-gather/reduce-scatter buffers
+    # Values already exported by the user take precedence over these defaults
+    os.environ.setdefault("TORCH_NCCL_AVOID_RECORD_STREAMS", str(1))
     # This flag will help with CUDA memory fragmentations that can lead into OOM in some cases.
-    # Note this is only availble in PyTorch Nighlies (as of July 30 2023)
-    # os.environ['PYTORCH_CUDA_ALLOC_CONF']='expandable_segments:True'
+    if train_config is None or train_config.use_expandable_segments:
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
     if rank == 0:
         print(f"--> Running with torch dist debug set to detail")
 
@@ -344,14 +371,17 @@ def print_model_size(model, config, rank: int = 0) -> None:
         rank (int, optional): Current process's rank. Defaults to 0.
     """
     if rank == 0:
-        total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        total_params = 0
+        for p in model.parameters():
+            if p.requires_grad:
+                total_params += p.numel()
         print(f"--> Model has {total_params / 1e6} Million params\n")
 
 
-def get_policies(cfg, rank):
-    """Get the policies for mixed precision and fsdp wrapping"""
-
-    verify_bfloat_support = (
+@functools.lru_cache()
+def _bf16_ready():
+    """Check once whether CUDA, the GPU and NCCL all support bfloat16"""
+    return bool(
     torch.version.cuda
     and torch.cuda.is_bf16_supported()
     and packaging.version.parse(torch.version.cuda).release >= (11, 0)
@@ -360,12 +390,15 @@ def get_policies(cfg, rank):
     )
 
 
+def get_policies(cfg, rank):
+    """Get the policies for mixed precision and fsdp wrapping"""
+
     mixed_precision_policy = None
     wrapping_policy = None
 
     # Mixed precision
     if cfg.mixed_precision:
-        bf16_ready = verify_bfloat_support
+        bf16_ready = _bf16_ready()
 
         if bf16_ready and not cfg.use_fp16:
             mixed_precision_policy = bfSixteen
@@ -386,7 +419,10 @@ def save_train_params(train_config, fsdp_config, rank):
     This function saves the train_config and FSDP config into a train_params.yaml.
     This will be used by converter script in the inference folder to fetch the HF model name or path.
     It also would be hepful as a log for future references.
+    Only rank 0 writes the file, the other ranks would write identical copies.
     """
+    if rank != 0:
+        return
     # Convert the train_config and fsdp_config objects to dictionaries,
     # converting all values to strings to ensure they can be serialized into a YAML file
     train_config_dict = {k: str(v) for k, v in vars(train_config).items() if not k.startswith('__')}
@@ -401,10 +437,9 @@ def save_train_params(train_config, fsdp_config, rank):
 
     save_dir = Path.cwd() / folder_name
     # If the directory does not exist, create it
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-    # Convert the dictionary to a YAML string
-    config_yaml = yaml.dump(train_params_dict, indent=4)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    # Convert the dictionary to a YAML string, with the libyaml dumper when it is available
+    config_yaml = yaml.dump(train_params_dict, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper), indent=4)
     file_name = os.path.join(save_dir,'train_params.yaml')
 
     # Check if there's a directory with the same name as the file
@@ -414,8 +449,7 @@ def save_train_params(train_config, fsdp_config, rank):
         # Write the YAML string to the file
         with open(file_name, 'w') as f:
             f.write(config_yaml)
-        if rank==0:
-            print(f"training params are saved in {file_name}")
+        print(f"training params are saved in {file_name}")
 
 
 def save_to_json(output_filename, train_step_loss, train_epoch_loss, val_step_loss, val_epoch_loss):